@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 from beancount.ingest import extract
-from beancount_degiro import DegiroAccount, DegiroDE
+from beancount_degiro import DegiroAccount, DegiroDE, OpenFigiSearch
 
 # example importer config for Degiro importer
 # use with "bean-extract ConfigDegiro.py /path/to/Account.csv
@@ -26,7 +26,38 @@ account = DegiroAccount(
     # DepositAccount: put in your checkings account if you want deposit transactions
     #DepositAccount         = 'Aktiva:DKB:Girokonto'                          # {currency}
     # ticker cache speeds up automatic ISIN -> ticker mapping
-    TickerCacheFile        = '.ticker_cache'
+    TickerCacheFile        = '.ticker_cache',
+    # resolve all new ISINs of an import in a few batched requests
+    #TickerBackend          = OpenFigiSearch(apikey=None),
+
+    # transactions whose uuid is already in the ledger are marked as duplicates ('mark')
+    # or left out of the output ('skip'). bean-extract still compares every marked entry
+    # with the ledger, only 'skip' makes re-importing an export cheap
+    duplicates = 'mark',
+
+    # book sells against the importer's lot index ('FIFO', 'LIFO' or 'HIFO'), seeded from the
+    # ledger, to emit explicit lot costs and PnL amounts. None leaves booking to beancount
+    booking = None,
+
+    # roll up liquidity fund price changes, interest and fees without order id into one
+    # transaction per currency and 'day', 'week' or 'month'. None keeps one transaction per row
+    rollup = None,
+
+    # assert the stock positions at the end of the import ('end') or of each 'day', 'week'
+    # or 'month'. Positions held before the import are taken from the ledger
+    stock_balances = None,
+    # warn about positions differing from a Degiro Portfolio.csv snapshot
+    #PortfolioFile          = '/path/to/Portfolio.csv',
+
+    # emit the prices of trades and currency exchanges: the last quote of each day, unless the
+    # ledger has the same price for the day. degiro-watch replaces the prices it wrote itself
+    prices = False,
+
+    # 'arrow' reads and classifies large exports with pyarrow (pip install beancount-degiro[arrow])
+    engine = 'pandas',
+
+    # Transactions.csv export of the same period: exact prices, fees and FX data per order
+    #TransactionsFile       = '/path/to/Transactions.csv',
 )
 
 CONFIG = [account]
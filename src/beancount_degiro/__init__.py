@@ -1,2 +1,3 @@
 from .degiro import DegiroAccount
 from .degiro_lang import DegiroDE, DegiroNL
+from .stockutil import OpenFigiSearch, StockSearch
@@ -0,0 +1,133 @@
+import argparse
+import logging
+import os
+import runpy
+import time
+
+from beancount import loader
+from beancount.core import data
+from beancount.ingest import cache
+from beancount.ingest.extract import DUPLICATE_META
+from beancount.parser import printer
+
+from .writer import PartitionedWriter, block_keys, merge_file
+
+class DegiroWatcher(object):
+    """Extracts the exports dropped into a directory as soon as they appear or grow.
+
+    The importers (and with them the ticker cache) are kept across files, and the
+    entries already written are remembered per account, so only new entries are
+    appended to the output: a ledger file, or a PartitionedWriter.
+    """
+    def __init__(self, importers, directory, output, existing_entries=None, interval=0.25):
+        self.importers = importers
+        self.directory = directory
+        self.output = output
+        self.interval = interval
+        # entries known to the ledger, passed to the importers as existing_entries
+        self.entries = list(existing_entries or [])
+        # identities of the ledger entries, see writer.block_keys
+        self.existing_keys = set(block_keys([printer.format_entry(e) for e in self.entries]))
+        # account -> key -> (printed entry, entry), of the entries written by this watcher
+        self.checkpoints = {}
+        # path -> (size, mtime) of the last extracted version
+        self.seen = {}
+        # path -> (size, mtime) of the last scan; extracted when unchanged at the next scan
+        self.pending = {}
+
+    def scan(self):
+        for de in os.scandir(self.directory):
+            if not de.is_file() or de.name.startswith('.'):
+                continue
+            st = de.stat()
+            state = (st.st_size, st.st_mtime_ns)
+            if self.seen.get(de.path) == state:
+                continue
+            if self.pending.get(de.path) != state:
+                # still being written?
+                self.pending[de.path] = state
+                continue
+            del self.pending[de.path]
+            self.seen[de.path] = state
+            self.process(de.path)
+
+    def process(self, path):
+        file = cache.get_file(os.path.abspath(path))
+        for importer in self.importers:
+            try:
+                if not importer.identify(file):
+                    continue
+                start = time.monotonic()
+                entries = importer.extract(file, existing_entries=self.entries)
+                count = self.write(importer.file_account(file), entries)
+                logging.log(logging.INFO, f'{path}: {count} new entries in {time.monotonic() - start:.3f}s')
+            except Exception as e:
+                logging.log(logging.ERROR, f'{path}: extraction with {importer.name()} failed: {e}')
+
+    def write(self, account, entries):
+        written = self.checkpoints.setdefault(account, {})
+        texts = [printer.format_entry(e) for e in entries]
+        new_entries = []
+        replaced = []
+        # keys are unique within entries; a key written before is superseded
+        for entry, text, key in zip(entries, texts, block_keys(texts)):
+            if entry.meta and entry.meta.get(DUPLICATE_META):
+                continue
+            if key in self.existing_keys:
+                continue
+            if key in written:
+                if written[key][0] == text:
+                    continue
+                # e.g. the balance of a day grown in the export
+                replaced.append(written[key][1])
+            written[key] = (text, entry)
+            new_entries.append((entry, text))
+        if not new_entries:
+            return 0
+
+        new_entries.sort(key=lambda et: data.entry_sortkey(et[0]))
+        if replaced:
+            superseded = set(map(id, replaced))
+            self.entries = [e for e in self.entries if id(e) not in superseded]
+        self.entries.extend(entry for entry, text in new_entries)
+        if isinstance(self.output, PartitionedWriter):
+            self.output.write_blocks((entry.date, text) for entry, text in new_entries)
+        else:
+            merge_file(self.output, [text for entry, text in new_entries])
+        return len(new_entries)
+
+    def run(self):
+        logging.log(logging.INFO, f'Watching {self.directory}')
+        try:
+            while True:
+                self.scan()
+                time.sleep(self.interval)
+        except KeyboardInterrupt:
+            pass
+
+def main():
+    parser = argparse.ArgumentParser(description='Extract Degiro exports as soon as they are dropped into a directory')
+    parser.add_argument('config', help='importer configuration, as used with bean-extract')
+    parser.add_argument('directory', help='directory to watch')
+    parser.add_argument('output', help='ledger file the new entries are appended to, '
+                        'or directory of the partitions with --partition')
+    parser.add_argument('-p', '--partition', choices=['year', 'month'],
+                        help='write into per-year or per-month include files')
+    parser.add_argument('-e', '--existing', help='ledger with the entries imported so far')
+    parser.add_argument('-i', '--interval', type=float, default=0.25, help='polling interval in seconds')
+    args = parser.parse_args()
+
+    importers = runpy.run_path(args.config)['CONFIG']
+    existing_entries = []
+    if args.existing:
+        existing_entries, errors, _ = loader.load_file(args.existing)
+        for error in errors:
+            logging.log(logging.WARNING, f'{args.existing}: {error.message}')
+
+    output = args.output
+    if args.partition:
+        output = PartitionedWriter(args.output, args.partition)
+    DegiroWatcher(importers, args.directory, output, existing_entries, args.interval).run()
+
+if __name__ == '__main__':
+    main()
@@ -4,20 +4,27 @@ import logging
 import sys
 import re
 import os
+import threading
 from datetime import datetime, timedelta
 from io import StringIO
 
 from beancount.core import data
 from beancount.core.amount import Amount
-from beancount.core.number import D
+from beancount.core.number import D, ZERO
 from beancount.core import position
 from beancount.ingest import importer
+from beancount.ingest.extract import DUPLICATE_META
 
 import uuid
-from collections import namedtuple
+from collections import namedtuple, deque
 from .stockutil import StockSearch
+from .lots import Lot, LotIndex, BOOKING_METHODS
 from .degiro_lang import DegiroLangInterface
 
+# the root logger is configured once per process, not per importer
+LOGGER_LOCK = threading.Lock()
+LOGGER_HANDLER = None
+
 class InvalidFormatError(Exception):
     def __init__(self, msg):
         pass
@@ -37,6 +44,89 @@ FIELDS_EN = (
     'orderid'
 )
 
+# Columns of the Transactions.csv export; older exports have no AutoFX fee column
+TRANSACTION_FIELDS = (
+    'date',
+    'time',
+    'product',
+    'isin',
+    'exchange',
+    'venue',
+    'quantity',
+    'price',
+    'c_price',
+    'local_value',
+    'c_local_value',
+    'value',
+    'c_value',
+    'exchange_rate',
+    'autofx_fee',
+    'fees',
+    'c_fees',
+    'total',
+    'c_total',
+    'orderid'
+)
+
+# Namespace of the content-addressed uuids generated for rows without order id
+UUID_NAMESPACE = uuid.UUID('5d0b7a4e-3c1f-4f6b-9a57-6b1e2c8d9f30')
+
+# Row fields which identify a row of the export independently of the import run
+FINGERPRINT_FIELDS = (
+    'datetime',
+    'product',
+    'isin',
+    'description',
+    'c_change',
+    'change',
+    'c_balance',
+    'balance',
+    'orderid'
+)
+
+def fingerprint(*rows):
+    """Deterministic uuid of a group of rows, derived from their content"""
+    content = '\n'.join('\x1f'.join(str(row[f]) for f in FINGERPRINT_FIELDS) for row in rows)
+    return str(uuid.uuid5(UUID_NAMESPACE, content))
+
+def row_contents(df):
+    """The content fingerprint() derives the uuid of each row of df from, column-wise"""
+    contents = df[FINGERPRINT_FIELDS[0]].map(str)
+    for f in FINGERPRINT_FIELDS[1:]:
+        contents = contents + '\x1f' + df[f].map(str)
+    return contents
+
+def content_uuid(*contents):
+    """fingerprint() of the rows of contents"""
+    return str(uuid.uuid5(UUID_NAMESPACE, '\n'.join(contents)))
+
+def uuid_index(entries):
+    """Set of uuid metadata of the transactions in entries, including the
+    uuids of the transactions rolled up into them"""
+    index = set()
+    for entry in entries or []:
+        if isinstance(entry, data.Transaction) and entry.meta and 'uuid' in entry.meta:
+            index.add(entry.meta['uuid'])
+            if 'uuids' in entry.meta:
+                index.update(entry.meta['uuids'].split())
+    return index
+
+def price_index(entries):
+    """(commodity, quote currency, date) -> price of the prices in entries; the last one of a day"""
+    return {(e.currency, e.amount.currency, e.date): e.amount.number for e in entries or [] if isinstance(e, data.Price)}
+
+PERIODS = ('day', 'week', 'month')
+
+def period_key(date, period):
+    if period == 'day':
+        return date.isoformat()
+    if period == 'week':
+        (year, week, _) = date.isocalendar()
+        return f'{year}-W{week:02d}'
+    if period == 'month':
+        return date.strftime('%Y-%m')
+    raise ValueError(f'Unsupported period {period}')
+
 class DegiroAccount(importer.ImporterProtocol):
     def __init__(self, language, LiquidityAccount, StocksAccount, SplitsAccount,
                  FeesAccount, InterestAccount,
@@ -44,7 +134,16 @@ class DegiroAccount(importer.ImporterProtocol):
                  RoundingErrorAccount,
                  DepositAccount=None,
                  TickerCacheFile=None,
-                 currency='EUR', file_encoding='utf-8' ):
+                 TickerBackend=None,
+                 currency='EUR', file_encoding='utf-8',
+                 duplicates='mark',
+                 booking=None,
+                 rollup=None,
+                 stock_balances=None,
+                 PortfolioFile=None,
+                 prices=False,
+                 engine='pandas',
+                 TransactionsFile=None):
 
         self.setup_logger()
 
@@ -68,6 +167,38 @@ class DegiroAccount(importer.ImporterProtocol):
         self.depositAccount = DepositAccount
         self.roundingErrorAccount = RoundingErrorAccount
         self.tickerCacheFile = TickerCacheFile
+        self.tickerBackend = TickerBackend
+        # kept across extract calls and shared by the importers using the same cache file,
+        # the ticker cache stays warm in long running processes
+        self.stocks = StockSearch.shared(TickerCacheFile, TickerBackend)
+        # Transactions already in the ledger: 'mark' as duplicate or 'skip' them
+        if duplicates not in ('mark', 'skip'):
+            raise ValueError(f'Unsupported duplicates mode {duplicates}')
+        self.duplicates = duplicates
+        # Book sells against the importer's own lot index ('FIFO', 'LIFO', 'HIFO')
+        # instead of leaving lot selection to beancount
+        if booking is not None and booking not in BOOKING_METHODS:
+            raise ValueError(f'Unsupported booking method {booking}')
+        self.booking = booking
+        # Roll up liquidity fund, interest and fee rows without order id per currency
+        # and period ('day', 'week', 'month') into one transaction each
+        if rollup is not None and rollup not in PERIODS:
+            raise ValueError(f'Unsupported rollup period {rollup}')
+        self.rollup = rollup
+        # Assert stock positions at the end of the import ('end') or of each 'day', 'week', 'month'
+        if stock_balances is not None and stock_balances != 'end' and stock_balances not in PERIODS:
+            raise ValueError(f'Unsupported stock balances period {stock_balances}')
+        self.stock_balances = stock_balances
+        # Degiro Portfolio.csv snapshot to cross-check the final positions with
+        self.portfolioFile = PortfolioFile
+        # Emit the prices of trades and currency exchanges
+        self.prices = prices
+        # 'pandas', or 'arrow' to read and classify with pyarrow
+        if engine not in ('pandas', 'arrow'):
+            raise ValueError(f'Unsupported engine {engine}')
+        self.engine = engine
+        # Degiro Transactions.csv export joined onto the trades by order id
+        self.transactionsFile = TransactionsFile
         self._date_from = None
         self._date_to = None
         self._balance_amount = None
@@ -76,6 +207,7 @@ class DegiroAccount(importer.ImporterProtocol):
         self._fx_match_tolerance_percent = 2.0
 
     def setup_logger(self):
+        global LOGGER_HANDLER
         env_loglevel = os.environ.get('PYTHON_LOG')
         level = {
             'DEBUG': logging.DEBUG,
@@ -83,12 +215,15 @@ class DegiroAccount(importer.ImporterProtocol):
             'WARNING': logging.WARNING,
             'ERROR': logging.ERROR
         }.get(env_loglevel, logging.INFO)
-        root=logging.getLogger()
-        root.setLevel(level)
-        handler = logging.StreamHandler(sys.stderr)
-        handler.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
-        root.addHandler(handler)
-        root.debug(f'loglevel={level}')
+        with LOGGER_LOCK:
+            if LOGGER_HANDLER is not None:
+                return
+            root=logging.getLogger()
+            root.setLevel(level)
+            LOGGER_HANDLER = logging.StreamHandler(sys.stderr)
+            LOGGER_HANDLER.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
+            root.addHandler(LOGGER_HANDLER)
+            root.debug(f'loglevel={level}')
 
     def name(self):
         return f'{self.__class__.__name__} importer'
@@ -106,7 +241,86 @@ class DegiroAccount(importer.ImporterProtocol):
         # fall back to file creation date.
         return None
 
-    def extract(self, _file, existing_entries=None):
+    def read_transactions(self):
+        """Fees and FX data per order id of a Transactions.csv export, and the exact
+        prices per order id and per execution, identified by order id and quantity"""
+        try:
+            tx = pd.read_csv(self.transactionsFile, encoding=self.file_encoding, header=0, dtype=str)
+        except Exception as e:
+            raise InvalidFormatError(f"Read file {self.transactionsFile} failed {e}")
+        fields = TRANSACTION_FIELDS
+        if len(tx.columns) == len(fields) - 1:
+            fields = tuple(f for f in fields if f != 'autofx_fee')
+        if len(tx.columns) != len(fields):
+            raise InvalidFormatError(f"{self.transactionsFile}: unexpected number of columns {len(tx.columns)}")
+        tx.columns = fields
+        tx = tx[tx['orderid'].notna()]
+        for f in ('quantity', 'price', 'exchange_rate', 'autofx_fee', 'fees'):
+            if f in tx:
+                tx[f] = tx[f].map(self.l.fmt_number, na_action='ignore')
+            else:
+                tx[f] = None
+
+        def total(s):
+            return sum(s.dropna(), ZERO)
+
+        def unique(s):
+            return s.iloc[0] if s.nunique() == 1 else None
+
+        orders = tx.groupby('orderid').agg(
+            tx_price         = ('price', unique),
+            tx_currency      = ('c_price', 'first'),
+            tx_venue         = ('venue', 'first'),
+            tx_exchange_rate = ('exchange_rate', 'first'),
+            tx_autofx_fee    = ('autofx_fee', total),
+            tx_fees          = ('fees', total),
+            tx_c_fees        = ('c_fees', 'first'),
+        )
+        # Account.csv rows carry the unsigned quantity of their execution
+        tx['quantity'] = tx['quantity'].map(abs, na_action='ignore')
+        executions = tx.groupby(['orderid', 'quantity']).agg(tx_execution_price = ('price', unique))
+        return orders, executions
+
+    def read_portfolio(self):
+        # Portfolio.csv: product, ISIN, quantity, closing price, value in local currency, value
+        pf = pd.read_csv(self.portfolioFile, encoding=self.file_encoding, header=0, usecols=[1, 2], dtype=str)
+        pf.columns = ['isin', 'held']
+        pf.dropna(subset=['isin'], inplace=True)  # cash rows
+        pf['held'] = pf['held'].map(self.l.fmt_number)
+        return pf
+
+    def stock_positions(self, df, stocks, existing_entries):
+        """Running position after each buy and sell row, per stock account and ticker"""
+        positions = df.loc[df['side'].notna(), ['datetime', 'isin', 'side', 'quantity', 'split']]
+        positions['quantity'] = positions['quantity'].where(positions['side'] == 'buy', -positions['quantity'])
+        if not len(positions.index):
+            return positions.assign(ticker=[], key=[], position=[])
+
+        tickers = {isin: stocks.isin2ticker(isin) for isin in positions['isin'].unique()}
+        positions['ticker'] = positions['isin'].map(tickers)
+        positions['key'] = [
+            ((self.splitsAccount if split else self.stocksAccount).format(isin=isin, ticker=tickers[isin]), tickers[isin])
+            for isin, split in zip(positions['isin'], positions['split'])
+        ]
+
+        # positions held before the first row of the file
+        opening = {}
+        start = df['datetime'].min().date()
+        for entry in existing_entries or []:
+            if not isinstance(entry, data.Transaction) or entry.date >= start:
+                continue
+            for p in entry.postings:
+                if p.cost is not None and p.units is not None:
+                    k = (p.account, p.units.currency)
+                    opening[k] = opening.get(k, ZERO) + p.units.number
+
+        positions['position'] = positions.groupby('key')['quantity'].transform(pd.Series.cumsum) \
+            + positions['key'].map(lambda k: opening.get(k, ZERO))
+        return positions
+
+    def read_pandas(self, _file):
+        """Read and sanitize the rows of the file, in reverse order.
+        Returns the rows and the line count"""
 
         def format_datetime(x):
             try:
@@ -119,17 +333,12 @@ class DegiroAccount(importer.ImporterProtocol):
             lines=f.readlines()
 
         if len(lines) < 1:
-            logging.log(logging.ERROR, f'Empty input')
-            return []
+            return None, 0
         header=lines[0]
         del lines[0]
         lines = [header] + list(reversed(lines))
         linecount = len(lines)
 
-        # map index to line number
-        def i2l(i:int):
-            return linecount-i
-
         try:
             df = pd.read_csv(StringIO(''.join(lines)), encoding=self.file_encoding,
                              header=0, names=FIELDS_EN,
@@ -152,7 +361,7 @@ class DegiroAccount(importer.ImporterProtocol):
         for idx, row in df.iterrows():
             if pd.isna(row['datetime']):
                 if fraction is not None:
-                    logging.log(logging.WARNING, f'line={i2l(fi)} too many broken lines')
+                    logging.log(logging.WARNING, f'line={linecount-idx} too many broken lines')
                 fraction=row
                 continue
 
@@ -172,6 +381,120 @@ class DegiroAccount(importer.ImporterProtocol):
         # and Degiro, and have no effect on the balance
         df=df[df['description'].map(lambda d: not self.l.cst(d))]
 
+        return df, linecount
+
+    def read_arrow(self, _file):
+        """read_pandas with a multithreaded Arrow reader and Arrow compute kernels.
+        Python objects are only created for the rows left after sanitization.
+        Returns the rows, the line count and the trade fields"""
+        try:
+            import numpy as np
+            import pyarrow as pa
+            import pyarrow.compute as pc
+            from pyarrow import csv
+        except ImportError:
+            raise ImportError("engine='arrow' requires pyarrow: pip install beancount-degiro[arrow]")
+
+        if os.path.getsize(_file.name) == 0:
+            return None, 0, None
+        try:
+            table = csv.read_csv(_file.name,
+                                 read_options=csv.ReadOptions(use_threads=True, skip_rows=1, column_names=FIELDS_EN,
+                                                              encoding=self.file_encoding),
+                                 convert_options=csv.ConvertOptions(column_types={f: pa.string() for f in FIELDS_EN},
+                                                                    strings_can_be_null=True))
+        except Exception as e:
+            raise InvalidFormatError(f"Read file {_file.name} failed {e}")
+
+        n = table.num_rows
+        linecount = n + 1
+        # The rows stay in file order; index of the row p is n-1-p, as if read in reverse order
+        index = pd.RangeIndex(n-1, -1, -1)
+
+        timestamps = pc.strptime(pc.binary_join_element_wise(table['date'], table['time'], ' '),
+                               format=self.l.datetime_format, unit='s', error_is_null=True)
+        columns = {f: pc.fill_null(table[f], '') for f in ('product', 'description', 'orderid')}
+
+        # some rows are broken into more rows: the row following a broken row (in file order)
+        # is its fraction. Merge the fractions now
+        broken = pc.is_null(timestamps)
+        def following(a, fill):
+            return pa.chunked_array(a.slice(1).chunks + [pa.array([fill], type=a.type)])
+        has_fraction = pc.and_(pc.invert(broken), following(broken, False))
+        for i in np.flatnonzero(pc.and_(broken, following(broken, False)).to_numpy(zero_copy_only=False)):
+            logging.log(logging.WARNING, f'line={i+2} too many broken lines')
+        for f, sep in (('product', ' '), ('description', ' '), ('orderid', '')):
+            columns[f] = pc.if_else(has_fraction,
+                                    pc.binary_join_element_wise(columns[f], following(columns[f], ''), sep),
+                                    columns[f])
+
+        # drop rows with empty datetime or empty change, and 'cash sweep transfer' rows
+        keep = pc.and_(pc.and_(pc.invert(broken), pc.is_valid(table['change'])),
+                       pc.invert(pc.match_substring_regex(columns['description'], pattern=f'^(?:{self.l.CST.pattern})')))
+        keep_np = keep.to_numpy(zero_copy_only=False)
+        index = index[keep_np]
+
+        rows = pa.table({
+            'datetime':    timestamps,
+            'valuta':      table['valuta'],
+            'product':     columns['product'],
+            'isin':        table['isin'],
+            'description': columns['description'],
+            'FX':          table['FX'],
+            'c_change':    table['c_change'],
+            'change':      table['change'],
+            'c_balance':   table['c_balance'],
+            'balance':     table['balance'],
+            'orderid':     columns['orderid'],
+        }).filter(keep)
+
+        trades = self.l.trade_fields_arrow(rows['description'], index)
+
+        df = rows.to_pandas()
+        df.index = index
+        for f in ('valuta', 'isin', 'c_change', 'c_balance'):
+            df[f] = df[f].where(df[f].notna(), np.nan)
+        for f in ('change', 'FX', 'balance'):
+            df[f] = df[f].map(self.l.fmt_number, na_action='ignore')
+        # reverse order
+        return df.iloc[::-1], linecount, trades
+
+    def extract(self, _file, existing_entries=None):
+
+        if self.engine == 'arrow':
+            (df, linecount, trades) = self.read_arrow(_file)
+        else:
+            (df, linecount) = self.read_pandas(_file)
+            if df is not None:
+                trades = self.l.trade_fields(df['description'])
+        if df is None:
+            logging.log(logging.ERROR, f'Empty input')
+            return []
+
+        # map index to line number
+        def i2l(i:int):
+            return linecount-i
+
+        # Quantity, price, currency and flags of buy and sell rows as columns
+        (trades, failed) = trades
+        if len(failed):
+            logging.log(logging.WARNING, f'{len(failed)} trade rows without quantity, price or currency:\n'
+                        + '\n'.join(f"  line={i2l(i)} description={df.loc[i, 'description']}" for i in failed))
+        df = df.join(trades)
+
+        df['tx'] = False
+        if self.transactionsFile:
+            # Exact prices and fees of the orders
+            (orders, executions) = self.read_transactions()
+            df = df.join(orders, on='orderid').join(executions, on=['orderid', 'quantity'])
+            # the price of the execution, or of the order if all its executions share it;
+            # otherwise the row keeps its own price
+            price = df['tx_execution_price'].where(df['tx_execution_price'].notna(), df['tx_price'])
+            joined = df['side'].notna() & price.notna()
+            df.loc[joined, 'price'] = price[joined]
+            df.loc[joined, 'currency'] = df.loc[joined, 'tx_currency']
+            df['tx'] = joined
+
         # Copy orderid as a new column uuid
         df['uuid']=df['orderid']
 
@@ -224,7 +547,7 @@ class DegiroAccount(importer.ImporterProtocol):
                 continue
             elif f['uuid'] == '':
                 # Generate uuid to match conversion later
-                muuid=str(uuid.uuid1())
+                muuid=fingerprint(b, f)
                 df.loc[bi, 'uuid'] = muuid
                 df.loc[fi, 'uuid'] = muuid
 
@@ -241,69 +564,72 @@ class DegiroAccount(importer.ImporterProtocol):
 
         dfn = df[df['uuid']=='']
 
-        idx_split = None # Consecutive stock split rows are matched
-        idx_isin_change = None # Consecutive ISIN change rows are matched
-        # Generate uuid for transactions without orderid
-        for idx, row in dfn.iterrows():
-            # liquidity fund price changes and fees: single line pro transaction
-            d=row['description']
-            if (self.l.liquidity_fund(d)
-                or
-                self.l.fees(d)
-                or
-                self.l.payout(d)
-                or
-                self.l.interest(d)
-                or
-                self.l.deposit(d)):
-                df.loc[idx, 'uuid'] = str(uuid.uuid1())
-                continue
-
-            if self.l.dividend(row['description']):
-                # Lookup other legs of dividend transaction
-                # 1. Dividend tax: ISIN match
-                mdfn=dfn[(dfn['isin']==row['isin'])
-                         & (dfn['datetime'] > row['datetime']-timedelta(days=31)) & (dfn['datetime'] < row['datetime']+timedelta(days=5) )
-                         & (dfn['description'].map(lambda d: bool(self.l.dividend_tax(d))))]
-                muuid=str(uuid.uuid1())
-                for midx, mrow in mdfn.iterrows():
-                    if df.loc[midx, 'uuid'] != '':
-                        logging.log(logging.WARNING, f"line={i2l(midx)} ambigous generated uuid")
-                    df.loc[midx, 'uuid'] = muuid
-                if df.loc[idx, 'uuid'] != '':
-                    logging.log(logging.WARNING, f"line={i2l(idx)} ambigous generated uuid")
-                df.loc[idx, 'uuid'] = muuid
-                continue
+        # Legs of corporate actions waiting for their other leg
+        pending_splits = {} # (datetime, product) -> indices
+        pending_isin_changes = {} # (datetime, change, currency) -> indices
+        pairs = []
+        # uuid of a multi-leg dividend -> index -> fingerprint of the leg
+        legs = {}
+
+        def match_pair(pending, key, other_key, idx, row, action):
+            waiting = pending.get(other_key)
+            if not waiting:
+                pending.setdefault(key, deque()).append(idx)
+                return
+            other_idx = waiting.popleft()
+            muuid=fingerprint(dfn.loc[other_idx], row)
+            logging.log(logging.DEBUG, f"line={i2l(other_idx)} line={i2l(idx)} marking {action} uuid={muuid}")
+            df.loc[other_idx, 'uuid'] = df.loc[idx, 'uuid'] = muuid
+            pairs.append((other_idx, idx))
+
+        # Generate uuid for transactions without orderid, classifying the rows column-wise
+        descriptions = dfn['description']
+        # liquidity fund price changes and fees: single line pro transaction
+        single = descriptions.map(lambda d: bool(self.l.liquidity_fund(d) or self.l.fees(d) or self.l.payout(d)
+                                                 or self.l.interest(d) or self.l.deposit(d)))
+        dividend = ~single & descriptions.map(lambda d: bool(self.l.dividend(d)))
+        dividend_tax = descriptions.map(lambda d: bool(self.l.dividend_tax(d)))
+        df.loc[single[single].index, 'uuid'] = row_contents(dfn[single]).map(content_uuid)
+
+        # Lookup other legs of dividend transactions
+        # 1. Dividend tax: ISIN match, from 31 days before to 5 days after the dividend
+        dividends = dfn.loc[dividend, ['isin', 'datetime']].dropna(subset=['isin']).reset_index()
+        taxes = dfn.loc[dividend_tax, ['isin', 'datetime']].reset_index()
+        matches = dividends.merge(taxes, on='isin', suffixes=('', '_tax'))
+        matches = matches[(matches['datetime_tax'] > matches['datetime'] - timedelta(days=31))
+                          & (matches['datetime_tax'] < matches['datetime'] + timedelta(days=5))]
+        dividend_taxes = matches.groupby('index')['index_tax'].agg(list).to_dict()
+        contents = row_contents(dfn[dividend | dividend_tax]).to_dict()
+        dividend_uuids = {}
+        for idx in dividend[dividend].index:
+            midxs = dividend_taxes.get(idx, [])
+            # the uuid covers every leg and changes when a leg shows up in a later export;
+            # the legs imported before are recognized by their own fingerprint
+            muuid=content_uuid(*(contents[i] for i in [idx, *midxs]))
+            if midxs:
+                legs[muuid] = {i: content_uuid(contents[i]) for i in [idx, *midxs]}
+            for midx in midxs:
+                if midx in dividend_uuids:
+                    logging.log(logging.WARNING, f"line={i2l(midx)} ambigous generated uuid")
+                dividend_uuids[midx] = muuid
+            dividend_uuids[idx] = muuid
+        if dividend_uuids:
+            df.loc[list(dividend_uuids), 'uuid'] = list(dividend_uuids.values())
+
+        # corporate actions and transitions between exchanges
+        for idx, row in dfn[~(single | dividend | dividend_tax)].iterrows():
             if self.l.split(row['description']):
-                if idx_split is None:
-                    idx_split = idx
-                    continue
-                other_row=dfn.loc[idx_split]
-                if other_row['datetime'] != row['datetime']:
-                    logging.log(logging.WARNING, f"line={i2l(idx_split)} line={i2l(idx)} split matching failed")
-                    idx_split=idx  # retry matching this row with following split row
-                    continue
-                muuid=str(uuid.uuid1())
-                logging.log(logging.DEBUG, f"line={i2l(idx_split)} line={i2l(idx)} marking split uuid={muuid}")
-                df.loc[idx_split, 'uuid'] = df.loc[idx, 'uuid'] = muuid
-                idx_split=None
+                key = (row['datetime'], row['product'])
+                match_pair(pending_splits, key, key, idx, row, 'split')
                 continue
             if self.l.isin_change(row['description']):
                 # ISIN Change of fonds: buy and sell the same amount for the same price
-                if idx_isin_change is None:
-                    idx_isin_change = idx
-                    continue
-                other_row=dfn.loc[idx_isin_change]
-                if other_row['datetime'] != row['datetime'] or other_row['change'] != -row['change'] or other_row['c_change'] != row['c_change']:
-                    logging.log(logging.WARNING, f"line={i2l(idx_isin_change)} line={i2l(idx)} ISIN change matching failed")
-                    idx_isin_change=idx  # retry matching this row with following ISIN change row
-                    continue
-                muuid=str(uuid.uuid1())
-                logging.log(logging.DEBUG, f"line={i2l(idx_isin_change)} line={i2l(idx)} marking ISIN change uuid={muuid}")
-                df.loc[idx_isin_change, 'uuid'] = df.loc[idx, 'uuid'] = muuid
-                idx_isin_change=None
+                match_pair(pending_isin_changes,
+                           (row['datetime'], row['change'], row['c_change']),
+                           (row['datetime'], -row['change'], row['c_change']),
+                           idx, row, 'ISIN change')
                 continue
-            if self.l.buy(row['description']):
+            if row['side'] == 'buy':
                 # transition between exchanges: buy and sell the same amount for the same price
                 mdfn=dfn[(dfn['datetime']==row['datetime']) & (dfn['isin']==row['isin'])
                          & (dfn['change']==-row['change']) & (dfn['c_change']==row['c_change'])]
@@ -315,22 +641,69 @@ class DegiroAccount(importer.ImporterProtocol):
                 df.drop(index=idx, inplace=True)
                 df.drop(index=mdfn.index, inplace=True)
 
-        stocks=StockSearch(self.tickerCacheFile)
+        for action, pending in (('split', pending_splits), ('ISIN change', pending_isin_changes)):
+            for indices in pending.values():
+                for idx in indices:
+                    logging.log(logging.WARNING, f"line={i2l(idx)} {action} matching failed")
+
+        # Difference between reported and calculated account balance, in the order of the file
+        prev_balance = df.groupby('c_balance')['balance'].shift()
+        checked = prev_balance.notna()
+        df['__bdiff'] = ZERO
+        df.loc[checked, '__bdiff'] = df.loc[checked, 'balance'] - (prev_balance[checked] + df.loc[checked, 'change'])
+        # Use fake lineno meta idx to keep order of entries
+        balances = {bc: {'line': idx, 'balance': row['balance'], 'date': row['datetime'].date()}
+                    for idx, row in df.groupby('c_balance').tail(1).iterrows()
+                    for bc in [row['c_balance']]}
+
+        # The legs of a corporate action may be interleaved with other rows of the same time.
+        # Move the first leg next to the second one to post them in one transaction.
+        order = pd.Series(range(len(df.index)), index=df.index, dtype=float)
+        for (first, second) in pairs:
+            if first in order.index and second in order.index:
+                order[first] = order[second] - 0.5
+        df = df.loc[order.sort_values(kind='stable').index]
+
+        stocks=self.stocks
+        stocks.prefetch(df['isin'].dropna().unique())
+
+        # uuids of transactions already imported
+        existing_uuids = uuid_index(existing_entries)
+
+        lots = None
+        if self.booking:
+            lots = LotIndex(self.booking)
+            lots.seed(existing_entries)
 
         def add_corr(target, corr, currency):
             if currency not in target:
                 target[currency] = 0
             target[currency] += corr
 
+        def add_tx_meta(row, ctx):
+            # fees and FX data of the order from Transactions.csv
+            if pd.notna(row['tx_venue']):
+                ctx['meta']['venue'] = row['tx_venue']
+            if row['tx_fees']:
+                ctx['meta']['fees'] = Amount(row['tx_fees'], row['tx_c_fees'])
+            if row['tx_autofx_fee']:
+                ctx['meta']['autofx_fee'] = Amount(row['tx_autofx_fee'], self.currency)
+            if pd.notna(row['tx_exchange_rate']):
+                ctx['meta']['exchange_rate'] = row['tx_exchange_rate']
+
         def handle_fees(vals, row, amount, line, ctx):
+            if row['orderid'] == '':
+                ctx['rollup'] = ('Fees', amount.currency)
             return 2, "Degiro", f"Fee: {row['description']}", \
                 [data.Posting(self.feesAccount.format(currency=amount.currency), -amount, None, None, None, None )]
 
         def handle_liquidity_fund(vals, row, amount, line, ctx):
+            ctx['rollup'] = ('Liquidity fund price change', amount.currency)
             return 2, "Degiro", "Liquidity fund price change", \
                 [data.Posting(self.interestAccount.format(currency=amount.currency), -amount, None, None, None, None )]
 
         def handle_interest(vals, row, amount, line, ctx):
+            ctx['rollup'] = ('Interest', amount.currency)
             return 2, "Degiro", f"Interest: {row['description']}", \
                 [data.Posting(self.interestAccount.format(currency=amount.currency), -amount, None, None, None, None )]
 
@@ -367,40 +740,46 @@ class DegiroAccount(importer.ImporterProtocol):
 
         def handle_buy(vals, row, amount, line, ctx):
             cost = position.CostSpec(
-                number_per=vals.price,
+                number_per=row['price'],
                 number_total=None,
-                currency=vals.currency,
+                currency=row['currency'],
                 date=row['datetime'].date(),
                 label=None,
                 merge=False)
 
             ticker=stocks.isin2ticker(row['isin'])
-            stockamount = Amount(vals.quantity,ticker)
+            stockamount = Amount(row['quantity'],ticker)
 
-            if vals.split:
+            if row['split']:
                 account = self.splitsAccount
                 tdesc=f"SPLIT {row['product']}"
-            elif vals.isin_change:
+            elif row['isin_change']:
                 account = self.stocksAccount
                 tdesc=f"ISIN CHANGE {row['product']} {ticker}"
             else:
                 account = self.stocksAccount
-                tdesc=f"BUY {row['product']} {stockamount.number} {ticker} @ {vals.price} {vals.currency}"
+                tdesc=f"BUY {row['product']} {stockamount.number} {ticker} @ {row['price']} {row['currency']}"
 
-            # calculate total cost rounding error
-            if (vals.currency != row['c_change']):
-                logging.log(logging.WARNING, f"line={line} currency price:{vals.currency}, change:{row['c_change']} mismatch")
-            else:
-                corr=-(vals.quantity * vals.price + row['change'])
-                add_corr(ctx['corr'], corr, row['c_change'])
+            if not row['tx']:
+                # calculate total cost rounding error; none with the exact price of the order
+                if (row['currency'] != row['c_change']):
+                    logging.log(logging.WARNING, f"line={line} currency price:{row['currency']}, change:{row['c_change']} mismatch")
+                else:
+                    corr=-(row['quantity'] * row['price'] + row['change'])
+                    add_corr(ctx['corr'], corr, row['c_change'])
+
+            account = account.format(isin=row['isin'], ticker=ticker)
+            if lots is not None and row['uuid'] not in existing_uuids:
+                # opened when the transaction is complete; sells of the same transaction shall not reduce it
+                ctx['lots'].append(((account, ticker), Lot(row['quantity'], row['price'], row['currency'], cost.date)))
 
             return 1, ticker, tdesc, \
-                [data.Posting(account.format(isin=row['isin'], ticker=ticker), stockamount, cost, None, None, None )]
+                [data.Posting(account, stockamount, cost, None, None, None )]
 
         def handle_sell(vals, row, amount, line, ctx):
 
             ticker=stocks.isin2ticker(row['isin'])
-            stockamount = Amount(-vals.quantity, ticker)
+            stockamount = Amount(-row['quantity'], ticker)
 
             cost=position.CostSpec(
                 number_per=None,
@@ -410,32 +789,59 @@ class DegiroAccount(importer.ImporterProtocol):
                 label=None,
                 merge=False)
 
-            sellPrice=Amount(vals.price, vals.currency)
+            sellPrice=Amount(row['price'], row['currency'])
 
-            if vals.split:
+            if row['split']:
                 account = self.splitsAccount
                 tdesc=f"SPLIT {row['product']} {ticker}"
-            elif vals.isin_change:
+            elif row['isin_change']:
                 account = self.stocksAccount
                 tdesc=f"ISIN CHANGE {row['product']} {ticker}"
             else:
                 account = self.stocksAccount
-                tdesc=f"SELL {row['product']} {stockamount.number} {ticker} @ {vals.price} {vals.currency}"
+                tdesc=f"SELL {row['product']} {stockamount.number} {ticker} @ {row['price']} {row['currency']}"
+
+            account = account.format(isin=row['isin'], ticker=ticker)
+            pnlAccount = self.pnlAccount.format(currency=row['c_change'], isin=row['isin'], ticker=ticker)
+
+            if not row['tx']:
+                # calculate total cost rounding error; none with the exact price of the order
+                if (row['currency'] != row['c_change']):
+                    logging.log(logging.WARNING, f"line={line} currency price:{row['currency']}, change:{row['c_change']} mismatch")
+                else:
+                    corr=-(-row['quantity'] * row['price'] + row['change'])
+                    add_corr(ctx['corr'], corr, row['c_change'])
+
+            reduced = None
+            if lots is not None and row['uuid'] not in existing_uuids:
+                reduced = lots.reduce((account, ticker), row['quantity'])
+                if reduced is None:
+                    logging.log(logging.WARNING, f"line={line} not enough lots of {ticker} in {account}, booking left to beancount")
+                elif any(lot.currency != row['currency'] for number, lot in reduced):
+                    logging.log(logging.WARNING, f"line={line} lot and sell currency mismatch, PnL left to beancount")
+
+            if reduced:
+                postings = [data.Posting(account, Amount(-number, ticker),
+                                         position.CostSpec(
+                                             number_per=lot.cost,
+                                             number_total=None,
+                                             currency=lot.currency,
+                                             date=lot.date,
+                                             label=None,
+                                             merge=False),
+                                         sellPrice, None, None)
+                            for number, lot in reduced]
+                if all(lot.currency == row['currency'] for number, lot in reduced):
+                    gain = sum(number * (row['price'] - lot.cost) for number, lot in reduced)
+                    add_corr(ctx['gains'], -gain, (pnlAccount, row['currency']))
+                    return 1, ticker, tdesc, postings
+            else:
+                postings = [data.Posting(account, stockamount, cost, sellPrice, None, None)]
 
-            postings = [data.Posting(account.format(isin=row['isin'], ticker=ticker),
-                                     stockamount, cost, sellPrice, None, None)]
             if not ctx['pnl']:
                 # pnl posting append only once per transaction
                 ctx['pnl'] = True
-                postings.append(data.Posting(self.pnlAccount.format(currency=row['c_change'], isin=row['isin'], ticker=ticker),
-                                             None, None, None, None, None))
-
-            # calculate total cost rounding error
-            if (vals.currency != row['c_change']):
-                logging.log(logging.WARNING, f"line={line} currency price:{vals.currency}, change:{row['c_change']} mismatch")
-            else:
-                corr=-(-vals.quantity * vals.price + row['change'])
-                add_corr(ctx['corr'], corr, row['c_change'])
+                postings.append(data.Posting(pnlAccount, None, None, None, None, None))
 
             return 1, ticker, tdesc, postings
 
@@ -445,18 +851,21 @@ class DegiroAccount(importer.ImporterProtocol):
             TT('Liquidity Fund Price Change', self.l.liquidity_fund, handle_liquidity_fund),
             TT('Fees',                        self.l.fees,           handle_fees),
             TT('Deposit',                     self.l.deposit,        handle_deposit),
-            TT('Buy',                         self.l.buy,            handle_buy),
-            TT('Sell',                        self.l.sell,           handle_sell),
             TT('Interest',                    self.l.interest,       handle_interest),
             TT('Dividend',                    self.l.dividend,       handle_dividend),
             TT('Dividend tax',                self.l.dividend_tax,   handle_dividend_tax),
             TT('Currency exchange',           self.l.change,         handle_change),
         ]
 
+        trade_handlers = {
+            'buy':  handle_buy,
+            'sell': handle_sell,
+        }
 
         postings = []
 
-        it=df.iterrows()
+        # plain dicts; indexing Series rows dominates the loop otherwise
+        it=zip(df.index, df.to_dict('records'))
 
         row=None
         idx=None
@@ -468,10 +877,11 @@ class DegiroAccount(importer.ImporterProtocol):
         description=NO_DESCRIPTION
         payee=NO_PAYEE
         def CTX_INIT():
-            return {'corr': {}, 'bcorr': {}, 'pnl': False}
+            return {'corr': {}, 'bcorr': {}, 'pnl': False, 'gains': {}, 'lots': [], 'rollup': None, 'meta': {}}
         ctx = CTX_INIT()
 
-        balances={}
+        # (category, currency, period) -> transactions to be rolled up
+        rollups={}
 
         entries = []
 
@@ -486,6 +896,12 @@ class DegiroAccount(importer.ImporterProtocol):
 
             if idx is None or ( prev_row is not None and (row['uuid'] != prev_row['uuid'])):
                 # previous transaction completed
+                for key, lot in ctx['lots']:
+                    lots.add(key, lot)
+                for (account, currency), gain in ctx['gains'].items():
+                    postings.append(
+                        data.Posting(account, Amount(gain, currency), None, None, None, None)
+                    )
                 for currency in ctx['corr']:
                     # Beancount ignores imprecision less than the half of least significant digit
                     if abs(ctx['corr'][currency]) >= 0.005:
@@ -505,18 +921,32 @@ class DegiroAccount(importer.ImporterProtocol):
                             )
                         )
 
-                if postings:
+                duplicate = prev_row is not None and prev_row['uuid'] in existing_uuids
+                if duplicate and self.duplicates == 'skip':
+                    logging.log(logging.DEBUG, f"line={i2l(prev_idx)} skipping duplicate uuid={prev_row['uuid']}")
+                elif postings:
                     uuid_meta = {'uuid':prev_row['uuid']}
+                    if prev_row['uuid'] in legs:
+                        uuid_meta['uuids'] = ' '.join(legs[prev_row['uuid']].values())
+                    uuid_meta.update(ctx['meta'])
+                    if duplicate:
+                        uuid_meta[DUPLICATE_META] = True
                     # Use fake lineno meta prev_idx to keep order of entries
-                    entries.append(data.Transaction(data.new_metadata(_file.name, prev_idx, uuid_meta),
-                                                    prev_row['datetime'].date(),
-                                                    self.FLAG,
-                                                    payee,
-                                                    description,
-                                                    data.EMPTY_SET, # tags
-                                                    data.EMPTY_SET, # links
-                                                    postings
-                                                    ))
+                    txn = data.Transaction(data.new_metadata(_file.name, prev_idx, uuid_meta),
+                                           prev_row['datetime'].date(),
+                                           self.FLAG,
+                                           payee,
+                                           description,
+                                           data.EMPTY_SET, # tags
+                                           data.EMPTY_SET, # links
+                                           postings
+                                           )
+                    if self.rollup and ctx['rollup'] and not duplicate:
+                        (category, currency) = ctx['rollup']
+                        rkey = (category, currency, period_key(txn.date, self.rollup))
+                        rollups.setdefault(rkey, []).append(txn)
+                    else:
+                        entries.append(txn)
                 postings = []
                 prio = PRIO_LAST
                 description=NO_DESCRIPTION
@@ -527,17 +957,18 @@ class DegiroAccount(importer.ImporterProtocol):
                 # prev_row was the last
                 break
 
-            # Check balance
-            if row['c_balance'] in balances:
-                #  Difference between reported and calculated account balance:
-                bdiff = row['balance'] - (balances[row['c_balance']]['balance'] + row['change'])
-                if bdiff != 0:
-                    logging.log(logging.DEBUG, f"line={i2l(idx)} applying balance correction {bdiff} {row['c_balance']}")
-                    add_corr(ctx['bcorr'], bdiff, row['c_balance'])
-                    add_corr(ctx['corr'], -bdiff, row['c_balance'])
+            if (row['uuid'] in legs and row['uuid'] not in existing_uuids
+                and legs[row['uuid']][idx] in existing_uuids):
+                # leg imported before the rest of its transaction was exported
+                logging.log(logging.DEBUG, f"line={i2l(idx)} skipping imported leg of uuid={row['uuid']}")
+                continue
 
-            # Use fake lineno meta idx to keep order of entries
-            balances[row['c_balance']]={'line': idx, 'balance': row['balance'], 'date': row['datetime'].date()}
+            # Check balance
+            bdiff = row['__bdiff']
+            if bdiff != 0:
+                logging.log(logging.DEBUG, f"line={i2l(idx)} applying balance correction {bdiff} {row['c_balance']}")
+                add_corr(ctx['bcorr'], bdiff, row['c_balance'])
+                add_corr(ctx['corr'], -bdiff, row['c_balance'])
 
             if self.l.deposit(row['description']) and self.depositAccount is None:
                 continue
@@ -548,22 +979,55 @@ class DegiroAccount(importer.ImporterProtocol):
 
             postings.append(data.Posting(self.liquidityAccount.format(currency=row['c_change']), amount, None, fxprice, None, None ))
 
-            match = False
-            for t in trtypes:
-                m=t.descriptor(row['description'])
-                if m:
-                    (np, npay, nd, npostings) = t.handler(m.vals, row, amount, i2l(idx), ctx)
-                    postings += npostings
-                    # Now set transaction description if posting is more important than the ones before
-                    if np < prio:
-                        payee=npay
-                        description=nd
-                        prio=np
-                    match = True
-                    break
-            if not match:
+            # trade rows are classified by their extracted fields
+            handler = trade_handlers.get(row['side'])
+            vals = None
+            if handler is not None and row['tx']:
+                # fees and FX data of the order, however the trade is booked
+                add_tx_meta(row, ctx)
+            if handler is None:
+                for t in trtypes:
+                    m=t.descriptor(row['description'])
+                    if m:
+                        (handler, vals) = (t.handler, m.vals)
+                        break
+            if handler:
+                (np, npay, nd, npostings) = handler(vals, row, amount, i2l(idx), ctx)
+                postings += npostings
+                # Now set transaction description if posting is more important than the ones before
+                if np < prio:
+                    payee=npay
+                    description=nd
+                    prio=np
+            else:
                 logging.log(logging.WARNING, f"line={i2l(idx)} no posting handler description={row['description']}")
 
+        for (category, currency, period), txns in rollups.items():
+            if len(txns) == 1:
+                entries.append(txns[0])
+                continue
+            units = {}
+            for txn in txns:
+                for p in txn.postings:
+                    add_corr(units, p.units.number, (p.account, p.units.currency))
+            uuids = ' '.join(txn.meta['uuid'] for txn in txns)
+            # dated to the last rolled up row to keep the balances continuous
+            last = txns[-1]
+            entries.append(
+                data.Transaction(
+                    data.new_metadata(_file.name, last.meta['lineno'],
+                                      {'uuid': str(uuid.uuid5(UUID_NAMESPACE, uuids)), 'uuids': uuids}),
+                    last.date,
+                    self.FLAG,
+                    "Degiro",
+                    f"{category} {period} ({len(txns)} rows)",
+                    data.EMPTY_SET, # tags
+                    data.EMPTY_SET, # links
+                    [data.Posting(account, Amount(number, currency), None, None, None, None)
+                     for (account, currency), number in units.items() if number != 0]
+                )
+            )
+
         for bc in balances:
             b=balances[bc]
             entries.append(
@@ -577,6 +1041,68 @@ class DegiroAccount(importer.ImporterProtocol):
                 )
             )
 
+        if self.prices:
+            # (commodity, quote currency, date) -> row index, price; the last one of a day wins
+            quotes = {}
+            # corporate actions carry bookkeeping prices, no market quotes
+            trades = df[df['side'].notna()]
+            trades = trades[~(trades['split'] | trades['isin_change'] | trades['payout']).astype(bool)]
+            for idx, isin, dt, price, currency in zip(trades.index, trades['isin'], trades['datetime'],
+                                                      trades['price'], trades['currency']):
+                quotes[(stocks.isin2ticker(isin), currency, dt.date())] = (idx, price)
+            if '__FX' in df:
+                fxs = df[df['__FX'].notna()]
+                for idx, dt, currency, fx in zip(fxs.index, fxs['datetime'], fxs['c_change'], fxs['__FX']):
+                    quotes[(currency, fx.currency, dt.date())] = (idx, fx.number)
+
+            existing_prices = price_index(existing_entries)
+            for (commodity, currency, date), (idx, price) in quotes.items():
+                # a later quote of the day supersedes the price in the ledger
+                if existing_prices.get((commodity, currency, date)) == price:
+                    continue
+                entries.append(
+                    data.Price(
+                        data.new_metadata(_file.name, idx),
+                        date,
+                        commodity,
+                        Amount(price, currency)
+                    )
+                )
+
+        if self.stock_balances or self.portfolioFile:
+            positions = self.stock_positions(df, stocks, existing_entries)
+
+            if self.stock_balances == 'end':
+                checkpoints = positions.groupby('key').tail(1)
+            elif self.stock_balances:
+                period = positions['datetime'].map(lambda dt: period_key(dt.date(), self.stock_balances))
+                checkpoints = positions.groupby([positions['key'], period]).tail(1)
+            else:
+                checkpoints = positions.iloc[0:0]
+            for idx, row in checkpoints.iterrows():
+                (account, ticker) = row['key']
+                entries.append(
+                    data.Balance(
+                        data.new_metadata(_file.name, idx),
+                        row['datetime'].date() + timedelta(days=1),
+                        account,
+                        Amount(row['position'], ticker),
+                        None,
+                        None,
+                    )
+                )
+
+            if self.portfolioFile:
+                held = positions.groupby('key').tail(1).groupby('isin')['position'].agg(sum)
+                check = pd.merge(held.reset_index(), self.read_portfolio(), on='isin', how='outer', indicator=True)
+                for _, row in check.iterrows():
+                    if row['_merge'] == 'right_only':
+                        logging.log(logging.DEBUG, f"ISIN {row['isin']} in portfolio not traded in {_file.name}")
+                        continue
+                    expected = row['held'] if row['_merge'] == 'both' else ZERO
+                    if row['position'] != expected:
+                        logging.log(logging.WARNING, f"ISIN {row['isin']} position {row['position']} mismatch, portfolio: {expected}")
+
         stocks.save_cache()
         return entries
 
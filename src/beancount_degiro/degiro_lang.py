@@ -32,14 +32,6 @@ class DegiroLangInterface(abc.ABC):
     def deposit(self, d):
         pass
 
-    @abc.abstractmethod
-    def buy(self, d):
-        pass
-
-    @abc.abstractmethod
-    def sell(self, d):
-        pass
-
     @abc.abstractmethod
     def dividend(self, d):
         pass
@@ -48,10 +40,6 @@ class DegiroLangInterface(abc.ABC):
     def dividend_tax(self, d):
         pass
 
-    @abc.abstractmethod
-    def cst(self, d):
-        pass
-
     @abc.abstractmethod
     def interest(self, d):
         pass
@@ -72,13 +60,111 @@ class DegiroLangInterface(abc.ABC):
     def isin_change(self, d):
         pass
 
+    # Compiled patterns of the trade descriptions, usually class attributes.
+    # extract reads the fields of the trades with them; the arrow engine runs them
+    # with RE2, so they may use named and non-capturing groups only.
+
+    @property
+    @abc.abstractmethod
+    def BUY(self):
+        """Buy rows, with the groups quantity, price, currency and the optional
+        prefixes split and isin_change"""
+
+    @property
+    @abc.abstractmethod
+    def SELL(self):
+        """Sell rows, with the groups of BUY and the optional prefix payout"""
+
+    @property
+    @abc.abstractmethod
+    def TRADE(self):
+        """Rows expected to match BUY or SELL; the others are reported"""
+
+    @property
+    @abc.abstractmethod
+    def CST(self):
+        """Cash sweep transfers, dropped when reading"""
+
+    def buy(self, d):
+        return process(self.BUY, d, self.trade_vals)
+
+    def sell(self, d):
+        return process(self.SELL, d, self.trade_vals)
+
+    def cst(self, d):
+        return process(self.CST, d)
+
+    def trade_vals(self, m):
+        return VALS(price=self.fmt_number(m.group('price')), quantity=self.fmt_number(m.group('quantity')),
+                    currency=m.group('currency'), split=bool(m.group('split')),
+                    isin_change=bool(m.group('isin_change')), payout=bool(m.groupdict().get('payout')))
+
+    def trade_fields(self, descriptions):
+        """Extract the fields of all buy and sell rows at once.
+
+        Returns a frame indexed like descriptions with the columns side ('buy' or
+        'sell'), quantity, price, currency, split, isin_change and payout for the
+        trade rows, and the index of the rows which look like trades but whose
+        fields could not be extracted.
+        """
+        trades = []
+        for side, pattern in (('buy', self.BUY), ('sell', self.SELL)):
+            t = descriptions.str.extract(pattern)
+            trades.append(self.trade_frame(side, t[t['quantity'].notna()]))
+        classified = descriptions.str.contains(self.TRADE)
+        return self.trade_result(pd.concat(trades), classified[classified].index)
+
+    def trade_fields_arrow(self, descriptions, index):
+        """trade_fields of an Arrow string array, with the Arrow regex kernels.
+        index is the pandas index of descriptions"""
+        import pyarrow.compute as pc
+
+        trades = []
+        for side, pattern in (('buy', self.BUY), ('sell', self.SELL)):
+            fields = pc.extract_regex(descriptions, pattern=pattern.pattern)
+            matched = fields.is_valid()
+            fields = pc.filter(fields, matched)
+            names = [fields.type.field(i).name for i in range(fields.type.num_fields)]
+            # Python objects only for the matched rows
+            t = pd.DataFrame({name: f.to_pandas() for name, f in zip(names, fields.flatten())})
+            t.index = index[matched.to_numpy(zero_copy_only=False)]
+            trades.append(self.trade_frame(side, t))
+        classified = pc.match_substring_regex(descriptions, pattern=self.TRADE.pattern)
+        return self.trade_result(pd.concat(trades), index[classified.to_numpy(zero_copy_only=False)])
+
+    def trade_frame(self, side, t):
+        def number(value):
+            try:
+                return self.fmt_number(value)
+            except Exception:
+                return None
+
+        def flag(group):
+            # optional group not taking part in the match: NaN (pandas) or '' (Arrow)
+            return t[group].notna() & (t[group] != '') if group in t else False
+
+        return pd.DataFrame({
+            'side':        side,
+            'quantity':    t['quantity'].map(number),
+            'price':       t['price'].map(number),
+            'currency':    t['currency'],
+            'split':       flag('split'),
+            'isin_change': flag('isin_change'),
+            'payout':      flag('payout'),
+        }, index=t.index)
+
+    def trade_result(self, trades, classified):
+        extracted = trades['quantity'].notna() & trades['price'].notna()
+        failed = classified.difference(trades[extracted].index)
+        return trades[extracted], failed
+
 class DR:
     match = None
     vals = None
     def __bool__(self):
         return bool(self.match)
 
-VALS = namedtuple('VALS', ['price', 'quantity', 'currency', 'split', 'isin_change'], defaults=[False])
+VALS = namedtuple('VALS', ['price', 'quantity', 'currency', 'split', 'isin_change', 'payout'], defaults=[False, False])
 
 def process(r, d, v=None):
     dr=DR()
@@ -128,19 +214,12 @@ class DegiroDE(DegiroLangInterface):
     def deposit(self, d):
         return process('(((SOFORT|flatex) )?Einzahlung)|(Auszahlung)', d)
 
-    def buy(self, d):
-        return process('^((AKTIENSPLIT: )|(ISIN-ÄNDERUNG: ))?Kauf ([\d.]+) zu je ([\d,]+) (\w+)', d,
-                            lambda m:
-                            VALS(price=self.fmt_number(m.group(5)), quantity=self.fmt_number(m.group(4)),
-                                 currency=m.group(6), split=bool(m.group(2)), isin_change=bool(m.group(3)))
-                            )
-
-    def sell(self, d):
-        return process('(((AKTIENSPLIT)|(AUSZAHLUNG ZERTIFIKAT)|(ISIN-ÄNDERUNG)): )?Verkauf ([\d.]+) zu je ([\d,]+) (\w+)', d,
-                            lambda m:
-                            VALS(price=self.fmt_number(m.group(7)), quantity=self.fmt_number(m.group(6)),
-                                 currency=m.group(8), split=bool(m.group(3)), isin_change=bool(m.group(5)))
-                       )
+    BUY = re.compile('^(?:(?P<split>AKTIENSPLIT: )|(?P<isin_change>ISIN-ÄNDERUNG: ))?'
+                     'Kauf (?P<quantity>[\d.]+) zu je (?P<price>[\d,]+) (?P<currency>\w+)')
+    SELL = re.compile('^(?:(?P<split>AKTIENSPLIT: )|(?P<payout>AUSZAHLUNG ZERTIFIKAT: )|(?P<isin_change>ISIN-ÄNDERUNG: ))?'
+                      'Verkauf (?P<quantity>[\d.]+) zu je (?P<price>[\d,]+) (?P<currency>\w+)')
+    # rows classified as trades, which shall match BUY or SELL
+    TRADE = re.compile('^(?:AKTIENSPLIT: |ISIN-ÄNDERUNG: |AUSZAHLUNG ZERTIFIKAT: )?(?:Kauf|Verkauf) ')
 
     def dividend(self, d):
         return process('(Dividende|(Ausschüttung.*))$', d)
@@ -148,8 +227,7 @@ class DegiroDE(DegiroLangInterface):
     def dividend_tax(self, d):
         return process('Dividendensteuer', d)
 
-    def cst(self, d):
-        return process('(flatex|Degiro) Cash Sweep Transfer', d)
+    CST = re.compile('(flatex|Degiro) Cash Sweep Transfer')
 
     def interest(self, d):
         return process('Flatex Interest', d)
@@ -205,19 +283,12 @@ class DegiroNL(DegiroLangInterface):
     def deposit(self, d):
         return process('.*(S|s)torting|Deposit', d)
 
-    def buy(self, d):
-        return process('^((AANDELENSPLIT: )|(ISIN-WIJZIGING: ))?Koop ([\d.]+) @ ([\d,]+) (\w+)', d,
-                            lambda m:
-                            VALS(price=self.fmt_number(m.group(5)), quantity=self.fmt_number(m.group(4)),
-                                 currency=m.group(6), split=bool(m.group(2)), isin_change=bool(m.group(3)))
-                            )
-
-    def sell(self, d):
-        return process('(((AANDELENSPLIT)|(UITBETALING CERTIFICAAT)|(ISIN-WIJZIGING)): )?Verkoop ([\d.]+) @ ([\d,]+) (\w+)', d,
-                            lambda m:
-                            VALS(price=self.fmt_number(m.group(7)), quantity=self.fmt_number(m.group(6)),
-                                 currency=m.group(8), split=bool(m.group(3)), isin_change=bool(m.group(5)))
-                       )
+    BUY = re.compile('^(?:(?P<split>AANDELENSPLIT: )|(?P<isin_change>ISIN-WIJZIGING: ))?'
+                     'Koop (?P<quantity>[\d.]+) @ (?P<price>[\d,]+) (?P<currency>\w+)')
+    SELL = re.compile('^(?:(?P<split>AANDELENSPLIT: )|(?P<payout>UITBETALING CERTIFICAAT: )|(?P<isin_change>ISIN-WIJZIGING: ))?'
+                      'Verkoop (?P<quantity>[\d.]+) @ (?P<price>[\d,]+) (?P<currency>\w+)')
+    # rows classified as trades, which shall match BUY or SELL
+    TRADE = re.compile('^(?:AANDELENSPLIT: |ISIN-WIJZIGING: |UITBETALING CERTIFICAAT: )?(?:Koop|Verkoop) ')
 
     def dividend(self, d):
         return process('(Dividend|(Uitkering.*))$', d)
@@ -225,8 +296,7 @@ class DegiroNL(DegiroLangInterface):
     def dividend_tax(self, d):
         return process('Dividendbelasting', d)
 
-    def cst(self, d):
-        return process('Degiro Cash Sweep Transfer', d)
+    CST = re.compile('Degiro Cash Sweep Transfer')
 
     def interest(self, d):
         return process('Flatex Interest?', d)
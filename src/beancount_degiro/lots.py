@@ -0,0 +1,117 @@
+import heapq
+import logging
+from collections import deque, namedtuple
+from itertools import count
+
+from beancount.core import data
+from beancount.core import position
+from beancount.core.number import Decimal, ZERO
+
+Lot = namedtuple('Lot', ['number', 'cost', 'currency', 'date'])
+
+class FifoLots(object):
+    # oldest lot first
+    def __init__(self):
+        self.lots = deque()
+
+    def push(self, lot):
+        self.lots.append(lot)
+
+    def pop(self):
+        return self.lots.popleft()
+
+    def push_back(self, lot):
+        # return the remainder of a partially reduced lot
+        self.lots.appendleft(lot)
+
+class LifoLots(FifoLots):
+    # newest lot first
+    def pop(self):
+        return self.lots.pop()
+
+    def push_back(self, lot):
+        self.lots.append(lot)
+
+class HifoLots(object):
+    # most expensive lot first
+    def __init__(self):
+        self.lots = []
+        self.counter = count()
+
+    def push(self, lot):
+        heapq.heappush(self.lots, (-lot.cost, next(self.counter), lot))
+
+    def pop(self):
+        return heapq.heappop(self.lots)[2]
+
+    push_back = push
+
+BOOKING_METHODS = {
+    'FIFO': FifoLots,
+    'LIFO': LifoLots,
+    'HIFO': HifoLots,
+}
+
+class LotIndex(object):
+    """Open lots per (account, commodity), reduced by the given booking method"""
+    def __init__(self, method='FIFO'):
+        if method not in BOOKING_METHODS:
+            raise ValueError(f'Unsupported booking method {method}')
+        self.book = BOOKING_METHODS[method]
+        self.lots = {}
+        self.totals = {}
+
+    def add(self, key, lot):
+        if key not in self.lots:
+            self.lots[key] = self.book()
+            self.totals[key] = ZERO
+        self.lots[key].push(lot)
+        self.totals[key] += lot.number
+
+    def available(self, key):
+        return self.totals.get(key, ZERO)
+
+    def reduce(self, key, number):
+        """Consume number units of key. Returns the list of (number, lot) reduced,
+        or None if the open lots do not cover number"""
+        if number > self.available(key):
+            return None
+        book = self.lots[key]
+        reduced = []
+        rest = number
+        while rest > 0:
+            lot = book.pop()
+            if lot.number > rest:
+                book.push_back(lot._replace(number=lot.number - rest))
+                reduced.append((rest, lot))
+                rest = ZERO
+            else:
+                reduced.append((lot.number, lot))
+                rest -= lot.number
+        self.totals[key] -= number
+        return reduced
+
+    def seed(self, entries):
+        """Open the lots held at cost in entries. Besides booked entries, unbooked ones
+        are accepted if their cost specs are complete, as extracted with booking"""
+        held = {}
+        for entry in entries or []:
+            if not isinstance(entry, data.Transaction):
+                continue
+            for posting in entry.postings:
+                cost = posting.cost
+                if isinstance(cost, position.CostSpec):
+                    if not (isinstance(cost.number_per, Decimal) and cost.currency and cost.date):
+                        continue
+                    cost = position.Cost(cost.number_per, cost.currency, cost.date, cost.label)
+                if not isinstance(cost, position.Cost) or posting.units is None:
+                    continue
+                lk = (posting.account, posting.units.currency,
+                      cost.number, cost.currency, cost.date)
+                held[lk] = held.get(lk, ZERO) + posting.units.number
+
+        for (account, commodity, cost, currency, date), number in sorted(held.items(), key=lambda h: h[0][4]):
+            if number > 0:
+                self.add((account, commodity), Lot(number, cost, currency, date))
+            elif number < 0:
+                logging.log(logging.WARNING, f'{account}: negative lot {number} {commodity} {{{cost} {currency}, {date}}}')
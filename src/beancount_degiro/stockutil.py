@@ -1,38 +1,202 @@
 import requests as r
 import pickle
 import logging
+import os
 import re
+import threading
+import time
+from collections import deque
+
+class OpenFigiSearch(object):
+    """ISIN -> ticker mapping in batches with an OpenFIGI style mapping API"""
+    def __init__(self, url='https://api.openfigi.com/v3/mapping', apikey=None,
+                 batch_size=None, rate_limit=None, exch_code=None, retries=3):
+        self.url = url
+        self.apikey = apikey
+        # OpenFIGI limits: 10 jobs per request and 25 requests per minute without API key,
+        # 100 jobs per request and 25 requests per 6 seconds with API key
+        self.batch_size = batch_size or (100 if apikey else 10)
+        self.rate_limit = rate_limit or ((25, 6.0) if apikey else (25, 60.0))
+        self.exch_code = exch_code
+        self.retries = retries
+        self.sent = deque()  # times of the requests in the current rate limit period
+        self.lock = threading.Lock()
+
+    def throttle(self):
+        # serialized, so concurrent resolvers share the rate limit
+        with self.lock:
+            count, period = self.rate_limit
+            now = time.monotonic()
+            while self.sent and now - self.sent[0] >= period:
+                self.sent.popleft()
+            if len(self.sent) >= count:
+                wait = period - (now - self.sent[0])
+                logging.log(logging.INFO, f"Rate limit reached, waiting {wait:.1f}s")
+                time.sleep(wait)
+                self.sent.popleft()
+            self.sent.append(time.monotonic())
+
+    def post(self, jobs):
+        headers = {'Content-Type': 'application/json'}
+        if self.apikey:
+            headers['X-OPENFIGI-APIKEY'] = self.apikey
+        for attempt in range(self.retries + 1):
+            self.throttle()
+            resp = r.post(self.url, headers=headers, json=jobs)
+            if resp.status_code == 429 and attempt < self.retries:
+                wait = float(resp.headers.get('ratelimit-reset', self.rate_limit[1]))
+                logging.log(logging.WARNING, f"Too many requests, retrying in {wait:.1f}s")
+                time.sleep(wait)
+                continue
+            resp.raise_for_status()
+            return resp.json()
+
+    def resolve(self, isins):
+        """Map isins to tickers with as few requests as the batch size allows.
+        ISINs not found are missing from the result"""
+        isins = list(isins)
+        tickers = {}
+        for i in range(0, len(isins), self.batch_size):
+            batch = isins[i:i+self.batch_size]
+            jobs = [{'idType': 'ID_ISIN', 'idValue': isin} for isin in batch]
+            if self.exch_code:
+                for job in jobs:
+                    job['exchCode'] = self.exch_code
+            logging.log(logging.INFO, f"Querying {len(batch)} ISINs...")
+            try:
+                results = self.post(jobs)
+            except Exception as e:
+                logging.log(logging.WARNING, f"Querying {len(batch)} ISINs failed: {e}")
+                continue
+            # results are in the order of the jobs
+            for isin, result in zip(batch, results):
+                if not result.get('data') or not result['data'][0].get('ticker'):
+                    logging.log(logging.DEBUG, f"ISIN {isin} not found: {result.get('warning', result.get('error'))}")
+                    continue
+                ticker = re.sub('[./ ]', '-', result['data'][0]['ticker'])
+                logging.log(logging.INFO, f"ISIN {isin} found, ticker: {ticker}")
+                tickers[isin] = ticker
+        return tickers
 
 class StockSearch(object):
-    def __init__(self, cachefile = None):
+    """ISIN -> ticker mapping with a pickled cache file.
+
+    Safe to share between threads: the cache is guarded by a lock, and concurrent
+    lookups of the same ISIN are coalesced into one query, the other callers wait
+    for its result. Network queries run outside the lock.
+    """
+    # cachefile -> StockSearch, see shared()
+    instances = {}
+    instances_lock = threading.Lock()
+
+    def __init__(self, cachefile = None, backend = None):
         self.cachefile = cachefile
         self.cache = None
         self.dirty = False
+        # batch resolver for prefetch, e.g. OpenFigiSearch
+        self.backend = backend
+        self.lock = threading.RLock()
+        # isin -> Event set when the query in flight for isin completed
+        self.inflight = {}
+
+    @classmethod
+    def shared(cls, cachefile = None, backend = None):
+        """The StockSearch of cachefile, shared by all importers of the process"""
+        if cachefile is None:
+            return cls(cachefile, backend)
+        key = os.path.abspath(cachefile)
+        with cls.instances_lock:
+            stocks = cls.instances.get(key)
+            if stocks is None:
+                stocks = cls.instances[key] = cls(cachefile, backend)
+            elif stocks.backend is None:
+                stocks.backend = backend
+            return stocks
 
     def save_cache(self):
-        if self.dirty:
-            if self.cachefile is not None:
-                with open(self.cachefile,'wb') as cf:
-                    logging.log(logging.INFO, 'Saving dump')
-                    pickle.dump(self.cache, cf)
+        with self.lock:
+            if not self.dirty or self.cachefile is None:
+                return
+            logging.log(logging.INFO, 'Saving dump')
+            # replace atomically, concurrent processes never read a partial dump
+            tmp = f'{self.cachefile}.{os.getpid()}.tmp'
+            with open(tmp,'wb') as cf:
+                pickle.dump(self.cache, cf)
+            os.replace(tmp, self.cachefile)
+            self.dirty = False
 
-    def isin2ticker(self, isin):
-        if self.cache is None:
-            if self.cachefile is not None:
-                # try to use cachefile
-                try:
-                    with open(self.cachefile,'rb') as cf:
-                        self.cache = pickle.load(cf)
-                except OSError as err:
-                    logging.log(logging.INFO, f"Could not open {self.cachefile}: {err}")
+    def load_cache(self):
+        with self.lock:
+            if self.cache is None:
+                if self.cachefile is not None:
+                    # try to use cachefile
+                    try:
+                        with open(self.cachefile,'rb') as cf:
+                            self.cache = pickle.load(cf)
+                    except OSError as err:
+                        logging.log(logging.INFO, f"Could not open {self.cachefile}: {err}")
+                        self.cache = {}
+                else:
                     self.cache = {}
-            else:
-                self.cache = {}
 
-        if isin in self.cache:
-            ticker=self.cache[isin]
-            logging.log(logging.DEBUG, f"Reuse from cache: {isin}:{ticker}")
-            return ticker
+    def claim(self, isins):
+        """Split uncached isins into those to be queried by the caller, and the
+        events of those already queried by another thread"""
+        with self.lock:
+            self.load_cache()
+            claimed, waiting = [], []
+            for isin in isins:
+                if isin in self.cache:
+                    continue
+                if isin in self.inflight:
+                    waiting.append(self.inflight[isin])
+                else:
+                    self.inflight[isin] = threading.Event()
+                    claimed.append(isin)
+            return claimed, waiting
+
+    def release(self, isins, tickers):
+        with self.lock:
+            if tickers:
+                self.cache.update(tickers)
+                self.dirty = True
+            for isin in isins:
+                self.inflight.pop(isin).set()
+
+    def prefetch(self, isins):
+        # resolve all uncached isins at once with the batch backend
+        if self.backend is None:
+            return
+        claimed, waiting = self.claim(sorted(set(isin for isin in isins if isin)))
+        if claimed:
+            found = {}
+            try:
+                found = self.backend.resolve(claimed)
+            finally:
+                self.release(claimed, found)
+        for event in waiting:
+            event.wait()
+
+    def isin2ticker(self, isin):
+        while True:
+            claimed, waiting = self.claim([isin])
+            if claimed:
+                break
+            if not waiting:
+                ticker=self.cache[isin]
+                logging.log(logging.DEBUG, f"Reuse from cache: {isin}:{ticker}")
+                return ticker
+            # queried by another thread; cached by now unless its batch lookup missed it
+            waiting[0].wait()
+
+        ticker=isin  # fallback
+        try:
+            ticker = self.query(isin)
+        finally:
+            self.release([isin], {isin: ticker})
+        return ticker
+
+    def query(self, isin):
         js = {}
         try:
             url = "https://query2.finance.yahoo.com/v1/finance/search"
@@ -46,14 +210,10 @@ class StockSearch(object):
 
         if not 'quotes' in js or len(js['quotes']) < 1:
             logging.log(logging.WARNING, f"ISIN {isin} not found")
-            ticker=isin  # fallback
-        else:
-            ticker = js['quotes'][0]['symbol']
-            ticker = re.sub('\.', '-', ticker)
-            logging.log(logging.INFO, f"ISIN {isin} found, ticker: {ticker}")
-
-        self.cache[isin]=ticker
-        self.dirty = True
+            return isin  # fallback
+        ticker = js['quotes'][0]['symbol']
+        ticker = re.sub('\.', '-', ticker)
+        logging.log(logging.INFO, f"ISIN {isin} found, ticker: {ticker}")
         return ticker
 
 #        def isin2ticker(isin):
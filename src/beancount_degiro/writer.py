@@ -0,0 +1,143 @@
+import hashlib
+import logging
+import os
+import re
+
+from beancount.core import data
+from beancount.parser import printer
+
+INDEX_LINE = re.compile(r'^include "([^"]+)"\s*; sha256:([0-9a-f]+)$')
+UUID_LINE = re.compile(r'^\s+uuid: "([^"]+)"$', re.M)
+
+def block_key(block):
+    """Identity of a printed entry: the uuid and date of transactions; date, directive,
+    account or commodity and currency of balances and prices; the text otherwise"""
+    tokens = block.split('\n', 1)[0].split()
+    m = UUID_LINE.search(block)
+    if m:
+        # the rows of an order or a dividend may be split into several transactions
+        # sharing the uuid, if other rows are in between; see block_keys
+        return f'{m.group(1)} {tokens[0]}'
+    if len(tokens) >= 4 and tokens[1] in ('balance', 'price'):
+        return ' '.join(tokens[:3] + tokens[-1:])
+    return block
+
+def block_keys(blocks):
+    """block_key of each of blocks, numbered to tell apart the blocks of the same key,
+    e.g. the transactions of an order interrupted by other rows of the same day"""
+    seen = {}
+    keys = []
+    for block in blocks:
+        k = block_key(block)
+        seen[k] = seen.get(k, -1) + 1
+        keys.append((k, seen[k]))
+    return keys
+
+def sha256(content):
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+def replace(path, content):
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write(content)
+    os.replace(tmp, path)
+
+def merge_file(path, new_blocks, digest=None):
+    """Merge printed entries into the file path, replacing the entries of the same key.
+    New entries are appended; the file is rewritten if an entry changed or its content
+    differs from digest. Returns the new content, or None if nothing was written"""
+    try:
+        with open(path, encoding='utf-8') as f:
+            content = f.read()
+    except FileNotFoundError:
+        content = ''
+    # entries are separated by an empty line
+    blocks = [b.strip('\n') + '\n' for b in content.split('\n\n') if b.strip()]
+    keys = {k: i for i, k in enumerate(block_keys(blocks))}
+
+    appended = []
+    changed = False
+    for block, k in zip(new_blocks, block_keys(new_blocks)):
+        if k not in keys:
+            keys[k] = len(blocks)
+            blocks.append(block)
+            appended.append(block)
+        elif blocks[keys[k]] != block:
+            blocks[keys[k]] = block
+            changed = True
+    if not appended and not changed:
+        return None
+
+    if changed or not content or (digest is not None and sha256(content) != digest):
+        logging.log(logging.INFO, f'Rewriting {path}')
+        content = '\n'.join(blocks)
+        replace(path, content)
+    else:
+        logging.log(logging.INFO, f'Appending {len(appended)} entries to {path}')
+        tail = '\n' + '\n'.join(appended)
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(tail)
+        content += tail
+    return content
+
+class PartitionedWriter(object):
+    """Writes entries into per-year or per-month include files of a directory.
+
+    The index file includes all partitions and records their content hashes.
+    Only partitions receiving new or changed entries are touched: new entries
+    are appended, and a partition is rewritten only if an entry changed or the
+    file differs from its recorded hash.
+    """
+    def __init__(self, directory, period='year', index='index.beancount'):
+        if period not in ('year', 'month'):
+            raise ValueError(f'Unsupported period {period}')
+        self.directory = directory
+        self.period = period
+        self.index = os.path.join(directory, index)
+
+    def partition(self, date):
+        if self.period == 'year':
+            return f'{date.year}.beancount'
+        return f'{date.year}-{date.month:02d}.beancount'
+
+    def read_index(self):
+        hashes = {}
+        try:
+            with open(self.index, encoding='utf-8') as f:
+                for line in f:
+                    m = INDEX_LINE.match(line.strip())
+                    if m:
+                        hashes[m.group(1)] = m.group(2)
+        except FileNotFoundError:
+            pass
+        return hashes
+
+    def write_index(self, hashes):
+        lines = ['; Degiro partitions, maintained by beancount-degiro\n']
+        lines += [f'include "{name}"  ; sha256:{hashes[name]}\n' for name in sorted(hashes)]
+        replace(self.index, ''.join(lines))
+
+    def write(self, entries):
+        """Merge entries into their partitions. Returns the names of the partitions written"""
+        return self.write_blocks((entry.date, printer.format_entry(entry)) for entry in data.sorted(entries))
+
+    def write_blocks(self, blocks):
+        """write for printed entries, as sorted (date, block) pairs"""
+        os.makedirs(self.directory, exist_ok=True)
+        hashes = self.read_index()
+
+        partitions = {}
+        for date, block in blocks:
+            partitions.setdefault(self.partition(date), []).append(block)
+
+        written = []
+        for name, new_blocks in sorted(partitions.items()):
+            content = merge_file(os.path.join(self.directory, name), new_blocks, hashes.get(name, ''))
+            if content is None:
+                continue
+            hashes[name] = sha256(content)
+            written.append(name)
+
+        if written:
+            self.write_index(hashes)
+        return written